@@ -3,7 +3,12 @@
 
 import os.path
 import sys
+import marshal
+import binascii
+import cPickle
 import logging
+from array import array
+from bisect import bisect_right
 
 class NullLogger(logging.Handler):
     def emit(self, record): pass
@@ -11,17 +16,17 @@ NullLogger = NullLogger()
 logging.getLogger("lepl").addHandler(NullLogger)
 del NullLogger, logging
 
-from lepl import Node, Word, Regexp, String, Drop, Delayed, \
-     Eos, Separator, Or, FullFirstMatchException, DroppedSpace
-
 from mpd import MPDFactory
 from twisted.internet import reactor, defer
 
+from queryclient import parse_bash_quotes
+
 # ================================================================================
 # Helper functions
 # ================================================================================
 
 def CaseInsensitiveLiteral(word):
+    from lepl import Regexp
     L = []
     for char in word:
         if char.lower() != char.upper():
@@ -32,6 +37,65 @@ def CaseInsensitiveLiteral(word):
 
 CIL = CaseInsensitiveLiteral
 
+class LRUCache(object):
+    """
+    A dict that forgets whatever was used least recently once it holds
+    more than size entries.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = {}
+        self.used = {}
+        self.clock = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        value = self.data[key]
+        self.clock += 1
+        self.used[key] = self.clock
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.data and len(self.data) >= self.size:
+            oldest = min(self.used, key=self.used.get)
+            del self.data[oldest], self.used[oldest]
+        self.data[key] = value
+        self.clock += 1
+        self.used[key] = self.clock
+
+    def __delitem__(self, key):
+        del self.data[key], self.used[key]
+
+    def items(self):
+        # Least recently used first, so setting them again in this
+        # order gets the order of use back.
+        return sorted(self.data.items(), key=lambda item: self.used[item[0]])
+
+    def clear(self):
+        self.data.clear()
+        self.used.clear()
+
+
+def save_file(path, write):
+    """
+    Call write with a temporary file next to path, then move it into
+    place, so a concurrent reader never sees half of it. Everything saved
+    this way is a cache, so a directory that can't be written to just
+    means it isn't saved.
+    """
+    try:
+        dirpath = os.path.dirname(path)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        temp = "%s.%d" % (path, os.getpid())
+        with open(temp, "wb") as f:
+            write(f)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        pass
 
 # Unfolding turns this:
 #    Comparison(AndNode(Tag("artist"), Tag("album")), "==", "foobar")
@@ -51,157 +115,1317 @@ def _unfold(method_name):
 # Node classes.
 # ================================================================================
 
+class Node(object):
+    """
+    A stand-in for lepl's Node, so that ASTs can be built, cached and
+    unpickled without importing LEPL. It's built the same way: a
+    ('name', value) pair becomes a child and is also appended to the list
+    attribute "name", a Node becomes a child named after its class, and
+    anything else is an anonymous child.
+    """
+
+    def __init__(self, *args):
+        self._children = []
+        self._names = []
+        for arg in args:
+            if isinstance(arg, (tuple, list)) and len(arg) == 2 and isinstance(arg[0], basestring):
+                name, value = arg
+            elif isinstance(arg, Node):
+                name, value = arg.__class__.__name__, arg
+            else:
+                name, value = None, arg
+            if name is not None:
+                self.__dict__.setdefault(name, []).append(value)
+            self._children.append(value)
+            self._names.append(name)
+
+    def __getitem__(self, index):
+        return self._children[index]
+
+    def __iter__(self):
+        return iter(self._children)
+
+    def __len__(self):
+        return len(self._children)
+
+    def __nonzero__(self):
+        return bool(self._children)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(...)'
+
+    def __str__(self):
+        return '\n'.join(self.tree_lines())
+
+    def tree_lines(self):
+        yield self.__class__.__name__
+        last = len(self._children) - 1
+        for i, (name, child) in enumerate(zip(self._names, self._children)):
+            first, rest = (' `- ', '    ') if i == last else (' +- ', ' |  ')
+            if isinstance(child, Node):
+                lines = child.tree_lines()
+            elif name is not None:
+                lines = iter(['%s %r' % (name, child)])
+            else:
+                lines = iter([repr(child)])
+            yield first + next(lines)
+            for line in lines:
+                yield rest + line
+
+# The planner orders the children of an AndNode by how many songs they're
+# expected to match, so the most selective one is searched first and the rest
+# only have to filter its results. These are rough guesses for leaves we
+# haven't seen yet; once a leaf has been searched its real result size is
+# remembered in CARDINALITIES.
+ESTIMATES = {'==': 100, 'like': 1000}
+ANY_FACTOR = 4
+CARDINALITIES = {}
+
+class SearchState(object):
+    """
+    What a single server-side search builds up: the info for every song MPD
+    sent back, and the result of every leaf that was searched, so a leaf
+    shared by several branches is only sent once.
+
+    Files are interned to small integers in the order they first show up,
+    so leaf results are sets of ints rather than of long paths, each song's
+    info is kept once however many leaves return it, and the first-seen
+    order is simply the order of the ids.
+    """
+
+    def __init__(self):
+        self.ids   = {}
+        self.songs = []
+        self.memo  = {}
+
+    def intern(self, song):
+        file = song['file']
+        id = self.ids.get(file)
+        if id is None:
+            id = self.ids[file] = len(self.songs)
+            self.songs.append(song)
+        return id
+
+    def add(self, leaf, songs):
+        intern = self.intern
+        S = self.memo[leaf] = set(intern(D) for D in songs if 'file' in D)
+        return S
+
 class Comparison(Node):
     def unfold_outer(self):
         return self.coll[0].unfold_collection(self)
 
+    def key(self):
+        return self.tag_[0].lower(), self.op[0].lower(), self.value[0]
+
+    def ident(self):
+        # 'like' doesn't care about case, so neither do its duplicates.
+        tag, op, value = self.key()
+        if op == '==':
+            return tag, op, decode(value)
+        return tag, op, fold_case(value)
+
+    def normalize(self, nodes):
+        return nodes.setdefault(self.ident(), self)
+
+    def leaves(self):
+        yield self
+
+    def combine(self, results):
+        return results[self]
+
+    def estimate(self, index=None):
+        tag, op, value = self.key()
+        if index is not None and op == '==':
+            return index.count(tag, value)
+        if self.key() in CARDINALITIES:
+            return CARDINALITIES[self.key()]
+        estimate = ESTIMATES.get(op, ESTIMATES['like'])
+        if tag == 'any':
+            estimate *= ANY_FACTOR
+        return estimate
+
+    def matches(self, song):
+        tag, op, value = self.key()
+        if tag == 'any':
+            # Like MPD, 'any' looks at the file's URI as well as its tags.
+            values = [v for t, V in song.iteritems() if t not in NON_TAGS
+                        for v in make_list(V)]
+        else:
+            values = make_list(song.get(tag, ()))
+
+        if op == '==':
+            value = decode(value)
+            return any(value == decode(v) for v in values)
+
+        needle = fold_case(value)
+        return any(needle in fold_case(v) for v in values)
+
+    def compile(self, index, engine="set"):
+        tag, op, value = self.key()
+
+        if engine == "bitmap":
+            lookup = index.find_bits if op == '==' else index.search_bits
+            def run(memo, candidates=None):
+                if self not in memo:
+                    memo[self] = lookup(tag, value)
+                return memo[self]
+            return run
+
+        lookup = index.find if op == '==' else index.search
+        songs, matches = index.songs, self.matches
+        values = index.count_values(tag)
+        def run(memo, candidates=None):
+            if self in memo:
+                S = memo[self]
+            elif op != '==' and candidates is not None and len(candidates) < values:
+                # Filtering a handful of candidates beats scanning every
+                # distinct value of the tag.
+                return set(id for id in candidates if matches(songs[id]))
+            else:
+                S = memo[self] = lookup(tag, value)
+            return S & candidates if candidates is not None else S
+        return run
+
     @defer.inlineCallbacks
-    def search(self, client, state=None, order=None):
-        op, tag, value = self.op[0], self.tag_[0], self.value[0]
+    def search(self, client, state=None, candidates=None):
+        tag, op, value = self.key()
         
         if state is None:
-            state = {}
-            order = []
+            state = SearchState()
+
+        if self in state.memo:
+            S = state.memo[self]
+            if candidates is not None:
+                S = S & candidates
+            defer.returnValue((S, state))
+
+        # Something before us in an AndNode already narrowed things down,
+        # and we have the info for all of those songs, so don't bother MPD.
+        if candidates is not None:
+            songs = state.songs
+            S = set(id for id in candidates if self.matches(songs[id]))
+            defer.returnValue((S, state))
         
         meth = client.search
         if op == '==':
             meth = client.find
 
         # Return a set to do intersections and unions on for AND and OR.
-        # "state" contains the filename => info mapping.
-        S = set()
-        for D in (yield meth(tag, value)):
-            if 'file' not in D:
-                continue
-            state[D['file']] = D
-            order.append(D['file'])
-            S.add(D['file'])
-        
-        defer.returnValue((S, state, order))
+        S = state.add(self, (yield meth(tag, value)))
+        CARDINALITIES[self.key()] = len(S)
+        defer.returnValue((set(S), state))
     
 class CombiningOp(Node):
     unfold_outer = _unfold('unfold_outer')
     unfold_collection = _unfold('unfold_collection')
 
+    def ident(self):
+        return self.__class__.__name__, frozenset(node.ident() for node in self)
+
+    def normalize(self, nodes):
+        """
+        Flatten nested nodes of the same kind, drop repeated children and
+        share identical subtrees, so that each distinct leaf in the query
+        is one object and only gets searched once.
+        """
+        children, seen = [], set()
+        for node in self:
+            node = node.normalize(nodes)
+            for child in (node if type(node) is type(self) else (node,)):
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    children.append(child)
+
+        if len(children) == 1:
+            return children[0]
+        node = self.__class__(*children)
+        return nodes.setdefault(node.ident(), node)
+
+    def leaves(self):
+        for node in self:
+            for leaf in node.leaves():
+                yield leaf
+
+    def matches(self, song):
+        return self.test(node.matches(song) for node in self)
+
+    def combine(self, results):
+        return self.op(*[node.combine(results) for node in self])
+
+# Fix a problem with the descriptor problem by using staticmethod.
+class AndNode(CombiningOp):
+    op = staticmethod(set.intersection)
+    test = staticmethod(all)
+
+    def estimate(self, index=None):
+        return min(node.estimate(index) for node in self)
+
+    def plan(self, index=None):
+        return sorted(self, key=lambda node: node.estimate(index))
+
     @defer.inlineCallbacks
-    def search(self, client, state=None, order=None):
+    def search(self, client, state=None, candidates=None):
         if state is None:
-            state = {}
-            order = []
+            state = SearchState()
 
-        L = []
-        for node in (node.search(client, state, order) for node in self):
-            node = yield node
-            L.append(node[0])
+        # Every child after the first only filters what's left, and
+        # once nothing is left there's nothing more to ask.
+        for node in self.plan():
+            candidates, state = yield node.search(client, state, candidates)
+            if not candidates:
+                break
 
-        defer.returnValue((self.op(*L), state, order))
+        defer.returnValue((candidates, state))
 
-# Fix a problem with the descriptor problem by using staticmethod.
-class AndNode(CombiningOp): op = staticmethod(set.intersection)
-class OrNode (CombiningOp): op = staticmethod(set.union)
+    def compile(self, index, engine="set"):
+        children = [node.compile(index, engine) for node in self.plan(index)]
+
+        if engine == "bitmap":
+            def run(memo, candidates=None):
+                bits = -1
+                for child in children:
+                    bits &= child(memo)
+                    if not bits:
+                        break
+                return bits
+            return run
+
+        def run(memo, candidates=None):
+            for child in children:
+                candidates = child(memo, candidates)
+                if not candidates:
+                    break
+            return candidates
+        return run
+
+class OrNode(CombiningOp):
+    op = staticmethod(set.union)
+    test = staticmethod(any)
+
+    def estimate(self, index=None):
+        return sum(node.estimate(index) for node in self)
+
+    @defer.inlineCallbacks
+    def search(self, client, state=None, candidates=None):
+        if state is None:
+            state = SearchState()
+
+        S = set()
+        for node in self:
+            R, state = yield node.search(client, state, candidates)
+            S |= R
+            # Every candidate already matched, the rest can't add anything.
+            if candidates is not None and len(S) == len(candidates):
+                break
+
+        defer.returnValue((S, state))
+
+    def compile(self, index, engine="set"):
+        children = [node.compile(index, engine) for node in self]
+
+        if engine == "bitmap":
+            def run(memo, candidates=None):
+                bits = 0
+                for child in children:
+                    bits |= child(memo)
+                return bits
+            return run
+
+        def run(memo, candidates=None):
+            S = set()
+            for child in children:
+                S |= child(memo, candidates)
+                if candidates is not None and len(S) == len(candidates):
+                    break
+            return S
+        return run
     
 class Tag(Node):
     def unfold_collection(self, comparison):
         return Comparison(('tag_', self[0]), ('value', comparison.value[0]), ('op', comparison.op[0]))
 
+# ================================================================================
+# Library index
+# ================================================================================
+
+# Keys in a song dict that are bookkeeping rather than tags.
+NON_TAGS = frozenset(('time', 'pos', 'id', 'prio', 'last-modified', 'duration'))
+
+def decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def fold_case(value):
+    return decode(value).lower()
+
+# Whether indexes build trigram posting lists for 'like'. They make
+# substring searches cost about as much as their matches, but take a while
+# to build and a lot of memory, so they only pay off in a long-lived process
+# or on a very large library.
+USE_TRIGRAMS = bool(os.getenv("MPDQUERY_TRIGRAMS"))
+
+# How many '==' bitmaps an index keeps around. Each one is a bit per song,
+# so a long-lived process asking about many values would otherwise hold
+# on to a copy of the library's size for every one of them.
+BITMAP_CACHE_SIZE = 512
+
+def make_list(v):
+    return list(v) if isinstance(v, (list, tuple)) else [v]
+
+class LibraryIndex(object):
+    """
+    An in-memory copy of the MPD library, built from one listallinfo.
+
+    Every song gets an integer id, in library order, and each tag has two
+    inverted indexes: one keyed by exact value, used for '==', and one keyed
+    by lowercased value, which 'like' scans for substrings. Since there are
+    far fewer distinct values than songs, this is much cheaper than asking
+    MPD once per Comparison.
+
+    Posting lists are sorted lists of ids rather than sets, as they're
+    smaller and much faster to load from a snapshot. File names are unique,
+    so they're looked up through "ids" instead of being indexed.
+    """
+
+    def __init__(self, songs=()):
+        self.songs = []
+        self.ids   = {}
+        self.exact = {}
+        self.lower = {}
+        self.bitmaps = LRUCache(BITMAP_CACHE_SIZE)
+        self.columns = {}
+        self.grams = {}
+        self.compiled = {}
+        self.use_trigrams = USE_TRIGRAMS
+        # The db_update this is a copy of, when known.
+        self.db_update = None
+        for song in songs:
+            self.add(song)
+
+    def changed(self):
+        self.bitmaps.clear()
+        self.columns.clear()
+        self.grams.clear()
+        self.compiled.clear()
+
+    def add(self, song):
+        # listallinfo also returns directories and playlists.
+        if 'file' not in song:
+            return
+        self.changed()
+        id = len(self.songs)
+        self.songs.append(song)
+        self.ids[song['file']] = id
+        for tag, values in song.iteritems():
+            if tag in NON_TAGS:
+                continue
+            for value in make_list(values):
+                # MPD's 'any' matches the URI too.
+                if tag != 'file':
+                    self.add_posting(tag, value, id)
+                self.add_posting('any', value, id)
+
+    def add_posting(self, tag, value, id):
+        for postings in (self.exact.setdefault(tag, {}).setdefault(decode(value), []),
+                         self.lower.setdefault(tag, {}).setdefault(fold_case(value), [])):
+            # A song can carry the same value twice, e.g. in 'any'.
+            if not postings or postings[-1] != id:
+                postings.append(id)
+
+    def postings(self, tag, value):
+        tag = tag.lower()
+        if tag == 'file':
+            # File names are kept just as MPD sent them.
+            value = encode(value)
+            return [self.ids[value]] if value in self.ids else []
+        return self.exact.get(tag, {}).get(decode(value), [])
+
+    def items(self, tag):
+        if tag == 'file':
+            return [(fold_case(song['file']), [id]) for id, song in enumerate(self.songs)]
+        return self.lower.get(tag, {}).items()
+
+    def trigrams(self, tag):
+        """
+        A posting list of value numbers for every three-character
+        substring of every lowercased value of a tag. Any value containing
+        a needle contains all of the needle's trigrams, so intersecting
+        their lists leaves only a few values to actually check.
+        """
+        if tag not in self.grams:
+            items = self.items(tag)
+            grams = {}
+            for k, (value, ids) in enumerate(items):
+                for gram in set(value[i:i+3] for i in xrange(len(value) - 2)):
+                    grams.setdefault(gram, []).append(k)
+            self.grams[tag] = grams, items
+        return self.grams[tag]
+
+    def column(self, tag):
+        """
+        All the lowercased values of a tag, joined into one string with
+        newlines (which MPD can't put in a tag), along with where each
+        value starts and its posting list. 'like' is then a loop of
+        find() over one buffer instead of a test per value.
+        """
+        if tag not in self.columns:
+            items = self.items(tag)
+            starts, postings, offset = array('l'), [], 0
+            for value, ids in items:
+                starts.append(offset)
+                postings.append(ids)
+                offset += len(value) + 1
+            self.columns[tag] = u'\n'.join(value for value, ids in items), starts, postings
+        return self.columns[tag]
+
+    def search_postings(self, tag, value):
+        needle = fold_case(value)
+        if u'\n' in needle:
+            return
+
+        if self.use_trigrams and len(needle) >= 3:
+            grams, items = self.trigrams(tag.lower())
+            lists = sorted((grams.get(needle[i:i+3], ()) for i in xrange(len(needle) - 2)), key=len)
+            found = set(lists[0])
+            for L in lists[1:]:
+                # Past this point checking what's left is cheaper
+                # than walking another long posting list.
+                if len(L) > 4 * len(found):
+                    break
+                found.intersection_update(L)
+            for k in found:
+                value, ids = items[k]
+                if needle in value:
+                    yield ids
+            return
+
+        buf, starts, postings = self.column(tag.lower())
+        i = buf.find(needle)
+        while i >= 0:
+            k = bisect_right(starts, i) - 1
+            yield postings[k]
+            if k + 1 == len(starts):
+                break
+            # Skip to the next value, a value only needs to match once.
+            i = buf.find(needle, starts[k + 1])
+
+    def find(self, tag, value):
+        return set(self.postings(tag, value))
+
+    def count(self, tag, value):
+        tag = tag.lower()
+        if tag == 'file':
+            return int(encode(value) in self.ids)
+        return len(self.exact.get(tag, {}).get(decode(value), ()))
+
+    def count_values(self, tag):
+        tag = tag.lower()
+        if tag == 'file':
+            return len(self.songs)
+        return len(self.lower.get(tag, ()))
+
+    def search(self, tag, value):
+        S = set()
+        for ids in self.search_postings(tag, value):
+            S.update(ids)
+        return S
+
+    def find_bits(self, tag, value):
+        key = tag.lower(), decode(value)
+        if key not in self.bitmaps:
+            self.bitmaps[key] = bitmap(self.postings(tag, value))
+        return self.bitmaps[key]
+
+    def search_bits(self, tag, value):
+        return bitmap(id for ids in self.search_postings(tag, value) for id in ids)
+
+# ================================================================================
+# Bitmaps
+# ================================================================================
+
+# The bitmap engine stores a set of song ids as a Python long with those bits
+# set, so AND and OR over results become & and |, which CPython does a machine
+# word at a time, instead of hashing every element of a set.
+
+def bitmap(ids):
+    buf = bytearray()
+    for id in ids:
+        byte = id >> 3
+        if byte >= len(buf):
+            buf.extend(bytearray(byte - len(buf) + 1))
+        buf[byte] |= 1 << (id & 7)
+    if not buf:
+        return 0
+    buf.reverse()
+    return int(binascii.hexlify(buf), 16)
+
+def bitmap_ids(bits):
+    # bin() is lowest bit last, so flip it and hop from one set bit to
+    # the next, which costs per match rather than per song.
+    s = bin(bits)[:1:-1]
+    i = s.find('1')
+    while i >= 0:
+        yield i
+        i = s.find('1', i + 1)
+
+# ================================================================================
+# Pipelining
+# ================================================================================
+
+def command_list(client, calls):
+    """
+    Send every (method, args) pair in calls without waiting for replies in
+    between, and fire with the list of their results. If the client can do
+    command lists, they all go out as one, otherwise they're simply all put
+    in flight at once.
+    """
+    if hasattr(client, 'command_list_ok_begin'):
+        client.command_list_ok_begin()
+        for meth, args in calls:
+            meth(*args)
+        return client.command_list_end()
+    return defer.gatherResults([meth(*args) for meth, args in calls])
+
+# MPD refuses command lists bigger than max_command_list_size, 2MB by
+# default, so big batches are sent in several.
+COMMAND_LIST_SIZE = 1000
+
+@defer.inlineCallbacks
+def command_lists(client, calls):
+    results = []
+    for i in xrange(0, len(calls), COMMAND_LIST_SIZE):
+        results.extend((yield command_list(client, calls[i:i + COMMAND_LIST_SIZE])))
+    defer.returnValue(results)
+
+@defer.inlineCallbacks
+def search_pipelined(ast, client):
+    """
+    Like ast.search, but sends every leaf to MPD at once, so a query costs
+    one round trip no matter how many Comparisons it has. The planner can't
+    skip leaves this way, so it's a win on slow links rather than on a busy
+    server.
+    """
+    # In tree order, so results come back in the same order every time.
+    leaves, seen = [], set()
+    for leaf in ast.leaves():
+        if leaf not in seen:
+            seen.add(leaf)
+            leaves.append(leaf)
+
+    calls = []
+    for leaf in leaves:
+        tag, op, value = leaf.key()
+        calls.append((client.find if op == '==' else client.search, (tag, value)))
+
+    state = SearchState()
+    for leaf, songs in zip(leaves, (yield command_list(client, calls))):
+        state.add(leaf, songs)
+
+    defer.returnValue((ast.combine(state.memo), state))
+
+@defer.inlineCallbacks
+def load_index(client):
+    defer.returnValue(LibraryIndex((yield client.listallinfo())))
+
+# ================================================================================
+# Keeping an index up to date
+# ================================================================================
+
+# After a rescan, only songs that changed since the index was taken are fetched
+# again, with "find modified-since" (MPD >= 0.19), along with the bare list of
+# file names to notice additions and removals. The new index is built next to
+# the old one, which keeps answering queries until it's swapped in.
+
+@defer.inlineCallbacks
+def update_index(index, client):
+    """
+    Return a new LibraryIndex for the library as it is now, reusing the
+    songs in index that haven't changed since index.db_update.
+    """
+    if index.db_update is None:
+        defer.returnValue((yield load_index(client)))
+    try:
+        changed = yield client.find('modified-since', str(index.db_update))
+    except Exception:
+        # Too old a server to ask; fetch everything.
+        defer.returnValue((yield load_index(client)))
+
+    changed = dict((song['file'], song) for song in changed if 'file' in song)
+    filenames = [entry['file'] for entry in (yield client.listall()) if 'file' in entry]
+
+    # A file can be new to MPD and still be older than the index, if it
+    # was copied or moved in with its mtime intact.
+    missing = [filename for filename in filenames
+               if filename not in changed and filename not in index.ids]
+    if missing:
+        calls = [(client.find, ('file', filename)) for filename in missing]
+        for songs in (yield command_lists(client, calls)):
+            for song in songs:
+                changed[song['file']] = song
+
+    songs = []
+    for filename in filenames:
+        song = changed.get(filename)
+        if song is None:
+            song = index.songs[index.ids[filename]]
+        songs.append(song)
+    defer.returnValue(LibraryIndex(songs))
+
+@defer.inlineCallbacks
+def watch_index(client):
+    """
+    Keep the index get_index returns up to date, for as long as client is
+    connected. client should be a connection of its own, as it spends most
+    of its time idle.
+    """
+    global _index
+    while True:
+        yield client.idle('database')
+        index = _index
+        if index is None:
+            continue
+
+        db_update = str((yield client.stats())['db_update'])
+        if db_update == index.db_update:
+            continue
+        new = yield update_index(index, client)
+        new.db_update = db_update
+        write_snapshot(new, db_update)
+
+        # Searches already running finish on the old index.
+        if _index is index:
+            _index = new
+
+# ================================================================================
+# Library snapshots
+# ================================================================================
+
+# mpdgrep and gtkfind are short-lived, so the index is kept on disk between
+# runs. It's stored with marshal, which is the fastest thing in the stdlib
+# to load plain lists, dicts, sets and strings. A snapshot is only used if
+# it was taken at the same db_update as the server has now.
+
+SNAPSHOT_VERSION = 3
+
+def snapshot_path():
+    return os.getenv("MPDQUERY_SNAPSHOT") or \
+        os.path.expanduser("~/.cache/mpdquery/%s-%s.snapshot" % (
+            os.getenv("MPD_HOST", "localhost"), os.getenv("MPD_PORT", 6600)))
+
+def write_snapshot(index, db_update):
+    save_file(snapshot_path(), lambda f: marshal.dump(
+        (SNAPSHOT_VERSION, str(db_update), index.songs, index.exact, index.lower), f))
+
+def read_snapshot(db_update=None):
+    """
+    Load the snapshot, if it was taken at db_update. Without db_update,
+    load it whenever it was taken.
+    """
+    try:
+        with open(snapshot_path(), "rb") as f:
+            version, snapshot_update, songs, exact, lower = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+    if version != SNAPSHOT_VERSION:
+        return None
+    if db_update is not None and snapshot_update != str(db_update):
+        return None
+
+    index = LibraryIndex()
+    index.songs = songs
+    index.ids   = dict((song['file'], id) for id, song in enumerate(songs))
+    index.exact = exact
+    index.lower = lower
+    index.db_update = snapshot_update
+    return index
+
+@defer.inlineCallbacks
+def refresh_snapshot(client):
+    db_update = (yield client.stats())['db_update']
+    index = read_snapshot()
+    if index is None:
+        index = yield load_index(client)
+    elif index.db_update != str(db_update):
+        index = yield update_index(index, client)
+    else:
+        defer.returnValue(index)
+    index.db_update = str(db_update)
+    write_snapshot(index, db_update)
+    defer.returnValue(index)
+
 # ================================================================================
 # Grammar
 # ================================================================================
 
-with DroppedSpace():
-    andExp = Delayed()
-    value  = (String() | Word()) > 'value'
+# The grammar is built the first time a query has to be parsed rather than at
+# import time, and parse results are kept in PARSE_CACHE, which is also saved
+# to disk. A repeated query from a hotkey never has to import LEPL at all.
 
-    or_    = Drop(Or('||', '|', CIL('or')))
-    and_   = Drop(Or('&&', '&', CIL('and')))
-    
-    tag    = (Drop("<") + Word() + Drop(">") |  Drop("%") + Word() + Drop("%")) > Tag
+_grammar = None
+
+def grammar():
+    global _grammar
+    if _grammar is not None:
+        return _grammar
+
+    from lepl import Word, String, Drop, Delayed, Eos, Or, DroppedSpace, args
+
+    # lepl only spreads the results over the arguments for its own Node
+    # class, so ours are wrapped in args().
+    with DroppedSpace():
+        andExp = Delayed()
+        value  = (String() | Word()) > 'value'
+
+        or_    = Drop(Or('||', '|', CIL('or')))
+        and_   = Drop(Or('&&', '&', CIL('and')))
+        
+        tag    = (Drop("<") + Word() + Drop(">") |  Drop("%") + Word() + Drop("%")) > args(Tag)
+
+        tagCO  = tag  [:,or_ ] > args(OrNode)
+        tagCA  = tagCO[:,and_] > args(AndNode)
+        tagC   = tagCA > 'coll'
+
+        comparator = Or('==', CIL('like')) > 'op'
+
+        comparison = (tagC & comparator & value) > args(Comparison)
+
+        atom = (Drop('(') & andExp & Drop(')')) | \
+               (Drop('[') & andExp & Drop(']')) | \
+               (Drop('{') & andExp & Drop('}')) | \
+               comparison
+
+        orExp   = atom [:,or_ ] > args(OrNode)
+        andExp += orExp[:,and_] > args(AndNode)
+
+        _grammar = andExp & Eos()
+
+    return _grammar
+
+# ================================================================================
+# Hand-written parser
+# ================================================================================
+
+# The same grammar as above, without LEPL. To give exactly the same trees it
+# backtracks the way LEPL does: alternatives are tried in order, repetitions
+# and words are greedy and give back one step at a time, and spaces or tabs
+# are allowed wherever the grammar above uses & or a separated repetition.
+# Every rule is a generator of (result, position) pairs in the order LEPL
+# would try them.
+
+class ParseError(Exception):
+    pass
+
+SPACE = u' \t'
+WHITESPACE = u' \t\n\r\x0b\x0c'
+
+class QueryParser(object):
+    def __init__(self, text):
+        self.text = decode(text)
+
+    def parse(self):
+        text = self.text
+        for node, i in self.and_exp(0):
+            if self.space(i) == len(text):
+                return node
+        raise ParseError(text)
+
+    def space(self, i):
+        text = self.text
+        while i < len(text) and text[i] in SPACE:
+            i += 1
+        return i
+
+    def literal(self, i, *options):
+        # Letters match either case, like CaseInsensitiveLiteral.
+        for option in options:
+            chunk = self.text[i:i+len(option)]
+            if len(chunk) == len(option) and \
+                    all(c in (o.lower(), o.upper()) for c, o in zip(chunk, option)):
+                yield chunk, i + len(option)
+
+    def separator(self, *options):
+        def separator(i):
+            for _, j in self.literal(self.space(i), *options):
+                yield self.space(j)
+        return separator
+
+    def repeat(self, item, separator, i):
+        for first, j in item(i):
+            for rest, k in self.repeat_tail(item, separator, j):
+                yield [first] + rest, k
+        yield [], i
+
+    def repeat_tail(self, item, separator, i):
+        for j in separator(i):
+            for first, k in item(j):
+                for rest, m in self.repeat_tail(item, separator, k):
+                    yield [first] + rest, m
+        yield [], i
+
+    def or_(self, i):
+        return self.separator(u'||', u'|', u'or')(i)
+
+    def and_(self, i):
+        return self.separator(u'&&', u'&', u'and')(i)
+
+    def word(self, i):
+        text, end = self.text, i
+        while end < len(text) and text[end] not in WHITESPACE:
+            end += 1
+        for j in xrange(end, i, -1):
+            yield text[i:j], j
+
+    def string(self, i):
+        text = self.text
+        if text[i:i+1] != u'"':
+            return
+
+        # Each escaped quote could also have been a backslash followed by
+        # the closing quote, which LEPL tries last escape first.
+        L, escapes, j = [], [], i + 1
+        while j < len(text) and text[j] != u'"':
+            if text[j] == u'\\' and text[j+1:j+2] == u'"':
+                escapes.append((u''.join(L) + u'\\', j + 2))
+                L.append(u'"')
+                j += 2
+            else:
+                L.append(text[j])
+                j += 1
+        if j < len(text):
+            yield u''.join(L), j + 1
+        for content, j in reversed(escapes):
+            yield content, j
+
+    def value(self, i):
+        for content, j in self.string(i):
+            # LEPL drops an empty string altogether.
+            yield [('value', content)] if content else [], j
+        for content, j in self.word(i):
+            yield [('value', content)], j
+
+    def tag(self, i):
+        for open, close in ((u'<', u'>'), (u'%', u'%')):
+            if self.text[i:i+1] == open:
+                for word, j in self.word(i + 1):
+                    if self.text[j:j+1] == close:
+                        yield Tag(word), j + 1
+
+    def tag_or(self, i):
+        for tags, j in self.repeat(self.tag, self.or_, i):
+            yield OrNode(*tags), j
+
+    def tag_and(self, i):
+        for tags, j in self.repeat(self.tag_or, self.and_, i):
+            yield AndNode(*tags), j
+
+    def comparison(self, i):
+        for coll, j in self.tag_and(i):
+            for op, k in self.literal(self.space(j), u'==', u'like'):
+                for value, m in self.value(self.space(k)):
+                    yield Comparison(('coll', coll), ('op', op), *value), m
 
-    tagCO  = tag  [:,or_ ] > OrNode
-    tagCA  = tagCO[:,and_] > AndNode
-    tagC   = tagCA > 'coll'
+    def atom(self, i):
+        for open, close in ((u'(', u')'), (u'[', u']'), (u'{', u'}')):
+            if self.text[i:i+1] == open:
+                for node, j in self.and_exp(self.space(i + 1)):
+                    j = self.space(j)
+                    if self.text[j:j+1] == close:
+                        yield node, j + 1
+        for node, j in self.comparison(i):
+            yield node, j
 
-    comparator = Or('==', CIL('like')) > 'op'
+    def or_exp(self, i):
+        for atoms, j in self.repeat(self.atom, self.or_, i):
+            yield OrNode(*atoms), j
 
-    comparison = (tagC & comparator & value) > Comparison
+    def and_exp(self, i):
+        for nodes, j in self.repeat(self.or_exp, self.and_, i):
+            yield AndNode(*nodes), j
 
-    atom = (Drop('(') & andExp & Drop(')')) | \
-           (Drop('[') & andExp & Drop(']')) | \
-           (Drop('{') & andExp & Drop('}')) | \
-           comparison
+# Which parser to use: "lepl" for the LEPL grammar, "rd" for QueryParser.
+PARSER = os.getenv("MPDQUERY_PARSER", "lepl")
 
-    orExp   = atom [:,or_ ] > OrNode
-    andExp += orExp[:,and_] > AndNode
+def parse_raw(string, parser=None):
+    """
+    Parse string into the tree the grammar produces, before unfolding.
+    Raises ParseError if it doesn't match.
+    """
+    if (parser or PARSER) == "rd":
+        return QueryParser(string).parse()
 
-    query   = andExp & Eos()
+    from lepl import FullFirstMatchException
+    try:
+        return grammar().parse(string)[0]
+    except FullFirstMatchException:
+        raise ParseError(string)
+
+def same_tree(a, b):
+    if isinstance(a, Node) or isinstance(b, Node):
+        return type(a) is type(b) and len(a) == len(b) and \
+            a._names == b._names and all(same_tree(x, y) for x, y in zip(a, b))
+    return a == b
+
+# Queries the parsers are expected to agree on: the README's examples and
+# the corners of the grammar.
+COMPARE_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_corpus.txt")
+
+def compare_parsers(strings):
+    """
+    Parse every string with both parsers and yield the ones where they
+    disagree, along with what each of them made of it.
+    """
+    for string in strings:
+        results = []
+        for parser in ("lepl", "rd"):
+            try:
+                results.append(parse_raw(string, parser))
+            except ParseError:
+                results.append(None)
+        if not same_tree(*results):
+            yield string, results[0], results[1]
+
+PARSE_CACHE_SIZE = 256
+PARSE_CACHE = None
+
+# Bump this whenever the Node classes or what the parsers build changes,
+# so trees pickled by an older version aren't used.
+PARSE_CACHE_VERSION = 1
+
+def parse_cache_path():
+    return os.getenv("MPDQUERY_PARSE_CACHE") or \
+        os.path.expanduser("~/.cache/mpdquery/queries.pickle")
+
+def load_parse_cache():
+    global PARSE_CACHE
+    PARSE_CACHE = LRUCache(PARSE_CACHE_SIZE)
+    if __name__ == '__main__':
+        # Run as a script, the Node classes live in __main__ rather than
+        # in query, so trees pickled one way can't be used the other.
+        return
+    try:
+        with open(parse_cache_path(), "rb") as f:
+            version, items = cPickle.load(f)
+        if version != PARSE_CACHE_VERSION:
+            return
+        for string, ast in items:
+            PARSE_CACHE[string] = ast
+    except Exception:
+        # A missing, old or corrupted cache is just an empty one.
+        pass
+
+def save_parse_cache():
+    if __name__ == '__main__':
+        return
+    save_file(parse_cache_path(), lambda f: cPickle.dump(
+        (PARSE_CACHE_VERSION, PARSE_CACHE.items()), f, cPickle.HIGHEST_PROTOCOL))
 
 # ================================================================================
 # Public interface.
 # ================================================================================
 
 def parse_query(string):
+    if PARSE_CACHE is None:
+        load_parse_cache()
+    if string in PARSE_CACHE:
+        return PARSE_CACHE[string]
+
+    ast = PARSE_CACHE[string] = _parse_query(string)
+    save_parse_cache()
+    return ast
+
+def _parse_query(string):
     try:
-        result = query.parse(string)
-    except FullFirstMatchException:
+        ast = parse_raw(string)
+    except ParseError:
         # Fallback for old-style mpdgrep search.
         return Comparison(('tag_', 'any'), ('op', 'like'), ('value', string))
 
-    ast = result[0]
     folded = ast.unfold_outer()
     if folded is not None:
-        return folded
-    return ast
+        ast = folded
+    return ast.normalize({})
+
+# How an index answers a query: "set" works on sets of song ids, "bitmap"
+# on bitmaps of them.
+ENGINE = os.getenv("MPDQUERY_ENGINE", "set")
+
+# How many compiled queries an index keeps around.
+COMPILED_CACHE_SIZE = 256
+
+# How queries get evaluated. "server" sends a search or find to MPD for
+# every Comparison, "pipeline" sends all of them in one command list,
+# "index" loads the library once and answers in process, and "snapshot"
+# uses the on-disk index if it's fresh and the server if not.
+STRATEGY = os.getenv("MPDQUERY_STRATEGY", "server")
+
+_index = None
 
 @defer.inlineCallbacks
-def search_ast(ast, client):
-    fileset, state, order = yield ast.search(client)
-    L = [state[f] for f in order if f in fileset]
+def get_index(client):
+    global _index
+    if _index is None:
+        db_update = (yield client.stats())['db_update']
+        _index = read_snapshot(db_update)
+        if _index is None and STRATEGY == "index":
+            _index = yield load_index(client)
+            _index.db_update = str(db_update)
+            write_snapshot(_index, db_update)
+    defer.returnValue(_index)
+
+@defer.inlineCallbacks
+def search_ast(ast, client, index=None):
+    if index is not None:
+        defer.returnValue(search_index(ast.compile(index, ENGINE), index))
+
+    if STRATEGY == "pipeline":
+        fileset, state = yield search_pipelined(ast, client)
+    else:
+        fileset, state = yield ast.search(client)
+    L = [state.songs[id] for id in sorted(fileset)]
     defer.returnValue(L)
 
+def compile_query(query, index):
+    """
+    Parse query and compile it against index, reusing the compiled
+    form if the same query was run against this index before.
+    """
+    key = query, ENGINE
+    if key not in index.compiled:
+        if len(index.compiled) >= COMPILED_CACHE_SIZE:
+            index.compiled.clear()
+        index.compiled[key] = parse_query(query).compile(index, ENGINE)
+    return index.compiled[key]
+
+def search_index(compiled, index):
+    result = compiled({})
+    if ENGINE == "bitmap":
+        ids = bitmap_ids(result)
+    else:
+        ids = sorted(result)
+    songs = index.songs
+    return [songs[id] for id in ids]
+
+@defer.inlineCallbacks
 def search(query, client):
-    return search_ast(parse_query(query), client)
+    index = None
+    if STRATEGY in ("index", "snapshot"):
+        index = yield get_index(client)
+    if index is not None:
+        defer.returnValue(search_index(compile_query(query, index), index))
+    defer.returnValue((yield search_ast(parse_query(query), client)))
+
+# How many songs search_stream hands over at a time when it already
+# has all of them.
+STREAM_BATCH = 200
+
+@defer.inlineCallbacks
+def search_stream(query, client, deliver):
+    """
+    Like search, but calls deliver with lists of songs as soon as they're
+    known to match, instead of waiting for the whole query. Every branch of
+    a top-level OR is delivered as it comes back from MPD, minus the songs
+    already delivered; anything else is only known at the end and arrives
+    in batches. Fires with the number of songs delivered.
+    """
+    index = None
+    if STRATEGY in ("index", "snapshot"):
+        index = yield get_index(client)
+
+    if index is not None:
+        songs = search_index(compile_query(query, index), index)
+    else:
+        ast = parse_query(query)
+        if STRATEGY != "server" or not isinstance(ast, OrNode):
+            songs = yield search_ast(ast, client)
+        else:
+            state, sent = SearchState(), set()
+            for node in ast:
+                S, state = yield node.search(client, state)
+                new = sorted(S - sent)
+                if new:
+                    sent.update(new)
+                    deliver([state.songs[id] for id in new])
+            defer.returnValue(len(sent))
+
+    for i in xrange(0, len(songs), STREAM_BATCH):
+        deliver(songs[i:i+STREAM_BATCH])
+    defer.returnValue(len(songs))
+
+def refines(old, new):
+    """
+    Whether everything new matches is sure to be matched by old too, so
+    new can be answered by filtering the results of old with new.matches.
+    Only plain structural cases are recognized, such as a 'like' whose
+    value grew, or old with another condition ANDed onto it.
+    """
+    if old is new or old.ident() == new.ident():
+        return True
+    if isinstance(new, AndNode) and any(refines(old, node) for node in new):
+        return True
+    if isinstance(new, OrNode):
+        return all(refines(old, node) for node in new)
+    if isinstance(old, AndNode):
+        return all(refines(node, new) for node in old)
+    if isinstance(old, OrNode):
+        return any(refines(node, new) for node in old)
+    if isinstance(old, Comparison) and isinstance(new, Comparison):
+        old_tag, old_op, old_value = old.ident()
+        new_tag, new_op, new_value = new.ident()
+        return old_tag == new_tag and old_op == new_op == 'like' and old_value in new_value
+    return False
+
+# ================================================================================
+# Playing
+# ================================================================================
+
+class PlayQueue(object):
+    """
+    MPD's queue as a map from file to songid, so finding a song doesn't make
+    the server scan the whole queue. It's kept up to date with plchanges,
+    which only returns what changed since the playlist version we last saw.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.entries = []
+        self.ids = {}
+        self.copies = {}
+
+    def apply(self, length, changes):
+        entries, ids, copies = self.entries, self.ids, self.copies
+        changes = [(int(song['pos']), song['file'], song['id']) for song in changes]
+
+        # Forget everything that was replaced or cut off first, as a song
+        # that moved can show up again at a position before its old one.
+        lost = set()
+        for pos, filename, songid in changes:
+            if pos < len(entries):
+                self.forget(entries[pos], lost)
+        for entry in entries[length:]:
+            self.forget(entry, lost)
+        del entries[length:]
+
+        for pos, filename, songid in changes:
+            if pos >= len(entries):
+                entries.extend([None] * (pos + 1 - len(entries)))
+            entries[pos] = filename, songid
+            ids[filename] = songid
+            copies[filename] = copies.get(filename, 0) + 1
+
+        # Files that are in the queue more than once can lose the songid
+        # we had for them while another copy stays.
+        lost = set(filename for filename in lost if filename not in ids)
+        if lost:
+            for entry in entries:
+                if entry is not None and entry[0] in lost:
+                    ids.setdefault(*entry)
+
+    def forget(self, entry, lost):
+        if entry is None:
+            return
+        filename, songid = entry
+        self.copies[filename] -= 1
+        if not self.copies[filename]:
+            del self.copies[filename]
+        if self.ids.get(filename) == songid:
+            del self.ids[filename]
+            if filename in self.copies:
+                lost.add(filename)
+
+    @defer.inlineCallbacks
+    def sync(self, client):
+        version = self.version or 0
+        status, changes = yield command_list(client, [(client.status, ()),
+                                                      (client.plchanges, (version,))])
+        if int(status['playlist']) < int(version):
+            # MPD restarted; start over.
+            self.__init__()
+            status, changes = yield command_list(client, [(client.status, ()),
+                                                          (client.plchanges, (0,))])
+        self.apply(int(status['playlistlength']), changes)
+        self.version = status['playlist']
+
+# The first sync fetches the whole queue, which costs more than the scan it
+# saves, so play only uses the map once something long-lived, like mpdqueryd,
+# has loaded it with get_queue.
+_queue = None
+
+@defer.inlineCallbacks
+def get_queue(client):
+    global _queue
+    if _queue is None:
+        _queue = PlayQueue()
+    yield _queue.sync(client)
+    defer.returnValue(_queue)
 
 @defer.inlineCallbacks
 def play(filename, client):
-    songs = list((yield client.playlistfind('file', filename)))
     songid = None
-    if songs:
-        songid = songs[0]['id']
+    if _queue is not None:
+        songid = (yield get_queue(client)).ids.get(filename)
     else:
+        songs = list((yield client.playlistfind('file', filename)))
+        if songs:
+            songid = songs[0]['id']
+    if songid is None:
         songid = yield client.addid(filename)
     yield client.playid(songid)
-    
-
-# This is sys.argv[1:], so any arguments that have spaces in them
-# were quoted by the user in shell. Put quotes around the search
-# terms that have spaces that have spaces in them to reserve this.
 
-# This function is complicated because (%title% like "Q u o t e d")
-# is sent to Python as ['(%title%', 'like', 'Q u o t e d)'], which
-# is then converted into '(%title% like "Q u o t e d")'
-def parse_bash_quotes(args):
-    L = []
-    for S in args:
-        if ' ' in S:
-            while S[0] in '([{':
-                L.append(S[0])
-                S = S[1:]
-            R = []
-            while S[-1] in ')]}':
-                R.append(S[-1])
-                S = S[:-1]
-            L.append('"%s"' % S)
-            L += R
-        else:
-            L.append(S)
-    return ' '.join(L)
+@defer.inlineCallbacks
+def enqueue(filenames, client):
+    """
+    Make sure every file is in the queue, adding the missing ones in one
+    command list, and fire with their songids.
+    """
+    queue = yield get_queue(client)
+    ids = dict((filename, queue.ids[filename]) for filename in filenames
+               if filename in queue.ids)
+    missing = []
+    for filename in filenames:
+        if filename not in ids and filename not in missing:
+            missing.append(filename)
+    if missing:
+        added = yield command_lists(client, [(client.addid, (filename,)) for filename in missing])
+        ids.update(zip(missing, added))
+    defer.returnValue([ids[filename] for filename in filenames])
+    
 
-def run(main):
+def connect(main):
     factory = MPDFactory()
     factory.connectionMade = main
     reactor.connectTCP(os.getenv("MPD_HOST", "localhost"), os.getenv("MPD_PORT", 6600), factory)
+
+def run(main):
+    connect(main)
     reactor.run()
 
+def snapshot_main(client):
+    deferred = refresh_snapshot(client)
+    deferred.addErrback(lambda failure: failure.printTraceback())
+    deferred.addBoth(lambda _: reactor.stop())
+
 if __name__ == '__main__':
-    t = parse_bash_quotes(sys.argv[1:])
-    print parse_query(t)
+    if sys.argv[1:] == ['--snapshot']:
+        run(snapshot_main)
+    elif sys.argv[1:2] == ['--compare']:
+        # Check the parsers against each other, one query per line, from
+        # the given file ('-' for stdin) or the corpus next to this one.
+        path = sys.argv[2] if sys.argv[2:] else COMPARE_CORPUS
+        f = sys.stdin if path == '-' else open(path)
+        strings = [line.rstrip('\n').decode('utf-8') for line in f if line.strip()]
+        failures = list(compare_parsers(strings))
+        for string, lepl_tree, rd_tree in failures:
+            print "%r\n  lepl: %s\n  rd:   %s" % (string, lepl_tree, rd_tree)
+        print "%d of %d queries differ" % (len(failures), len(strings))
+        sys.exit(1 if failures else 0)
+    else:
+        t = parse_bash_quotes(sys.argv[1:])
+        print parse_query(t)
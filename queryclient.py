@@ -0,0 +1,88 @@
+# Thin client for mpdqueryd.
+#
+# This only uses the standard library, so a front-end that talks to a
+# running mpdqueryd doesn't have to import Twisted or LEPL, or connect
+# to MPD itself. Requests and replies are single lines of JSON:
+#
+#   {"call": "search", "args": ["%artist% like zac"]}
+#   {"result": [{"file": ..., "artist": ...}, ...]}
+#   {"error": "..."}
+
+import os
+import os.path
+import socket
+
+try:
+    import json
+except ImportError:
+    # Python 2.5
+    import simplejson as json
+
+# How many seconds to wait on mpdqueryd before doing the work in process.
+# It may be alive but stuck, e.g. on a stalled connection to MPD.
+TIMEOUT = float(os.getenv("MPDQUERY_TIMEOUT", 10))
+
+class DaemonUnavailable(Exception):
+    """
+    There's no mpdqueryd to talk to; do the work in process instead.
+    """
+
+class DaemonError(Exception):
+    """
+    mpdqueryd got the request, but the call failed.
+    """
+
+def socket_path():
+    return os.getenv("MPDQUERY_SOCKET") or \
+        os.path.expanduser("~/.cache/mpdquery/%s-%s.socket" % (
+            os.getenv("MPD_HOST", "localhost"), os.getenv("MPD_PORT", 6600)))
+
+def call(name, *args):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(TIMEOUT)
+    try:
+        try:
+            sock.connect(socket_path())
+        except socket.error:
+            raise DaemonUnavailable(socket_path())
+
+        try:
+            sock.sendall(json.dumps({"call": name, "args": args}) + "\n")
+            f = sock.makefile("rb")
+            line = f.readline()
+            f.close()
+        except socket.timeout:
+            raise DaemonUnavailable(socket_path())
+    finally:
+        sock.close()
+
+    if not line:
+        raise DaemonUnavailable(socket_path())
+    reply = json.loads(line)
+    if "error" in reply:
+        raise DaemonError(reply["error"])
+    return reply["result"]
+
+# This is sys.argv[1:], so any arguments that have spaces in them
+# were quoted by the user in shell. Put quotes around the search
+# terms that have spaces that have spaces in them to reserve this.
+
+# This function is complicated because (%title% like "Q u o t e d")
+# is sent to Python as ['(%title%', 'like', 'Q u o t e d)'], which
+# is then converted into '(%title% like "Q u o t e d")'
+def parse_bash_quotes(args):
+    L = []
+    for S in args:
+        if ' ' in S:
+            while S[0] in '([{':
+                L.append(S[0])
+                S = S[1:]
+            R = []
+            while S[-1] in ')]}':
+                R.append(S[-1])
+                S = S[:-1]
+            L.append('"%s"' % S)
+            L += R
+        else:
+            L.append(S)
+    return ' '.join(L)